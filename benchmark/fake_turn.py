@@ -1,33 +1,158 @@
 import asyncio
+import binascii
+import math
+import os
 import random
-from uuid import uuid4
+from collections import defaultdict, deque
 
+import orjson
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import HTTPResponse
 
-app = Sanic("fake_turn")
+app = Sanic("fake_turn", configure_logging=False)
 
 MINIMUM_LATENCY = 0.05
 MAXIMUM_LATENCY = 0.5
 
+# Pool of pregenerated random hex IDs, so that we're not calling uuid4 per request
+ID_POOL_SIZE = 2048
+ID_POOL_LOW_WATERMARK = 256
+_id_pool: deque = deque()
+_id_pool_refill_scheduled = False
+
+
+def _refill_id_pool(n=ID_POOL_SIZE):
+    global _id_pool_refill_scheduled
+    _id_pool_refill_scheduled = False
+    # Hex the whole buffer in one go, and then slice it up into IDs
+    hexed = binascii.hexlify(os.urandom(16 * n)).decode("ascii")
+    for start in range(0, len(hexed), 32):
+        end = start + 32
+        _id_pool.append(hexed[start:end])
+
+
+def next_id():
+    """
+    Returns a random 32 character hex ID, in the same format as uuid4().hex
+    """
+    global _id_pool_refill_scheduled
+    if not _id_pool:
+        _refill_id_pool()
+    elif len(_id_pool) < ID_POOL_LOW_WATERMARK and not _id_pool_refill_scheduled:
+        # Top up the pool outside of the request that noticed it was running low
+        _id_pool_refill_scheduled = True
+        asyncio.get_event_loop().call_soon(_refill_id_pool)
+    return _id_pool.popleft()
+
+
+# Pool of presampled latencies, resampled every time we've gone through all of them
+LATENCY_POOL_SIZE = 65536
+_latencies: list = []
+_latency_index = 0
+
+
+def _resample_latencies(n=LATENCY_POOL_SIZE):
+    uniform = random.uniform
+    _latencies[:] = [uniform(MINIMUM_LATENCY, MAXIMUM_LATENCY) for _ in range(n)]
+
+
+def next_latency():
+    """
+    Returns a random latency between MINIMUM_LATENCY and MAXIMUM_LATENCY
+    """
+    global _latency_index
+    if _latency_index >= len(_latencies):
+        _resample_latencies()
+        _latency_index = 0
+    latency = _latencies[_latency_index]
+    _latency_index += 1
+    return latency
+
+
+# Requests sleep until the end of a bucket of this size, so that a single timer can
+# wake up all the requests in a bucket, instead of scheduling a timer per request
+TIMER_RESOLUTION = 0.01
+_timer_buckets: dict = defaultdict(list)
+_timer_task = None
+
+
+async def _run_timer_wheel():
+    global _timer_task
+    loop = asyncio.get_event_loop()
+    try:
+        while _timer_buckets:
+            await asyncio.sleep(TIMER_RESOLUTION)
+            current_bucket = math.floor(loop.time() / TIMER_RESOLUTION)
+            for bucket in [b for b in _timer_buckets if b <= current_bucket]:
+                for future in _timer_buckets.pop(bucket):
+                    if not future.done():
+                        future.set_result(None)
+    finally:
+        _timer_task = None
+
+
+async def fake_latency():
+    """
+    Sleeps for a random latency, rounded up to the nearest TIMER_RESOLUTION
+    """
+    global _timer_task
+    loop = asyncio.get_event_loop()
+    bucket = math.ceil((loop.time() + next_latency()) / TIMER_RESOLUTION)
+    future = loop.create_future()
+    _timer_buckets[bucket].append(future)
+    if _timer_task is None:
+        _timer_task = loop.create_task(_run_timer_wheel())
+    await future
+
+
+def ojson(body, status=200):
+    """
+    Like sanic.response.json, but serialises with orjson straight to bytes
+    """
+    return HTTPResponse(
+        body_bytes=orjson.dumps(body), status=status, content_type="application/json"
+    )
+
+
+# The message and media responses only differ by ID, so we can skip serialising them
+MESSAGE_RESPONSE_PREFIX = b'{"messages":[{"id":"'
+MEDIA_RESPONSE_PREFIX = b'{"media":[{"id":"'
+ID_RESPONSE_SUFFIX = b'"}]}'
+
+
+def id_response(prefix, status=201):
+    return HTTPResponse(
+        body_bytes=prefix + next_id().encode("ascii") + ID_RESPONSE_SUFFIX,
+        status=status,
+        content_type="application/json",
+    )
+
+
+@app.listener("before_server_start")
+async def fill_pools(app, loop):
+    # Each worker fills its own pools after forking, so that workers don't hand out
+    # the same IDs, and the first requests don't pay for filling them
+    _refill_id_pool()
+    _resample_latencies()
+
 
 @app.post("/v1/messages")
 async def create_message(request):
-    await asyncio.sleep(random.uniform(MINIMUM_LATENCY, MAXIMUM_LATENCY))
-    return json({"messages": [{"id": uuid4().hex}]}, status=201)
+    await fake_latency()
+    return id_response(MESSAGE_RESPONSE_PREFIX)
 
 
 @app.post("/v1/media")
 async def create_media(request):
-    await asyncio.sleep(random.uniform(MINIMUM_LATENCY, MAXIMUM_LATENCY))
-    return json({"media": [{"id": uuid4().hex}]}, status=201)
+    await fake_latency()
+    return id_response(MEDIA_RESPONSE_PREFIX)
 
 
 @app.post("v1/messages/<message_id>/automation")
 async def rerun_automation(request, message_id):
-    await asyncio.sleep(random.uniform(MINIMUM_LATENCY, MAXIMUM_LATENCY))
-    return json({}, status=201)
+    await fake_latency()
+    return ojson({}, status=201)
 
 
 if __name__ == "__main__":
-    app.run(port=8080)
+    app.run(port=8080, workers=os.cpu_count() or 1, access_log=False)
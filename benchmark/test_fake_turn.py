@@ -1,4 +1,5 @@
 import time
+from unittest import mock
 
 import pytest
 
@@ -7,28 +8,26 @@ from .fake_turn import MINIMUM_LATENCY, app
 
 @pytest.mark.asyncio
 async def test_create_message():
-    start = time.time()
+    start = time.monotonic()
     request, response = await app.asgi_client.post("/v1/messages")
-    assert time.time() - start > MINIMUM_LATENCY
+    assert time.monotonic() - start > MINIMUM_LATENCY
     assert response.status == 201
     assert response.json()["messages"][0]["id"]
 
 
 @pytest.mark.asyncio
 async def test_create_media():
-    start = time.time()
-    request, response = await app.asgi_client.post("/v1/media")
-    assert time.time() - start > MINIMUM_LATENCY
+    with mock.patch("benchmark.fake_turn.next_latency", return_value=0):
+        request, response = await app.asgi_client.post("/v1/media")
     assert response.status == 201
     assert response.json()["media"][0]["id"]
 
 
 @pytest.mark.asyncio
 async def test_rerun_automation():
-    start = time.time()
-    request, response = await app.asgi_client.post(
-        "/v1/messages/test-message-id/automation"
-    )
-    assert time.time() - start > MINIMUM_LATENCY
+    with mock.patch("benchmark.fake_turn.next_latency", return_value=0):
+        request, response = await app.asgi_client.post(
+            "/v1/messages/test-message-id/automation"
+        )
     assert response.status == 201
     assert response.json() == {}
@@ -1,520 +1,827 @@
+import asyncio
+import base64
 import hashlib
 import json
 import os
 import time
-from unittest import TestCase, mock
+from unittest import mock
 from unittest.mock import Mock
 
 import asyncpg
 import httpx
+import orjson
 import pytest
+from pytest_sanic import utils as pytest_sanic_utils
 from rasa.core import run, utils
 from rasa.core.events import UserUttered
 from sanic import Sanic
 from sanic import exceptions as sanic_exceptions
 from sanic import response
 
-from turn_rasa_connector.turn import TurnInput, TurnOutput
+from turn_rasa_connector.turn import (
+    TurnInput,
+    TurnOutput,
+    get_max_age,
+    media_cache,
+    retry_backoff,
+)
 
 POSTGRESQL_URL = os.environ.get("TEST_POSTGRES_URL", "postgres://")
 
+TEXT_MESSAGE_BODY = orjson.dumps(
+    {
+        "messages": [
+            {
+                "type": "text",
+                "text": {"body": "message body"},
+                "from": "27820001001",
+                "id": "message-id",
+                "timestamp": "1518694235",
+            }
+        ]
+    }
+)
 
-class TurnInputTests(TestCase):
-    def setUp(self):
-        self.input_channel = self._create_input_channel()
-        self.app = run.configure_app([self.input_channel])
 
-    def _create_input_channel(
-        self, hmac_secret=None, url="https://turn", token="testtoken"
-    ):
-        return TurnInput(
-            hmac_secret=hmac_secret,
-            url=url,
-            token=token,
-            postgresql_url=None,
-            http_retries=3,
-        )
+class RecordingAgent:
+    """
+    Records the messages that the webhook hands to the agent
+    """
 
-    def test_from_credentials(self):
-        """
-        Stores the credentials on the class
-        """
-        instance = TurnInput.from_credentials(
-            {
-                "hmac_secret": "test-secret",
-                "url": "https://turn",
-                "token": "testtoken",
-                "postgresql_url": "postgresql://",
-                "http_retries": 3,
-            }
-        )
-        self.assertEqual(instance.hmac_secret, "test-secret")
-        self.assertEqual(instance.url, "https://turn")
-        self.assertEqual(instance.token, "testtoken")
-        self.assertEqual(instance.postgresql_url, "postgresql://")
-        self.assertEqual(instance.http_retries, 3)
+    def __init__(self):
+        self.calls = []
 
-    def test_no_credentials(self):
-        """
-        Raises an exception
-        """
-        with self.assertRaises(Exception):
-            TurnInput.from_credentials({})
+    async def handle_message(self, message, **kwargs):
+        self.calls.append((message, kwargs))
 
-    def test_routes(self):
-        """
-        All routes should be set up correctly
-        """
-        routes = utils.list_routes(self.app)
-        self.assertTrue(routes.get("turn_webhook.health").startswith("/webhooks/turn"))
-        self.assertTrue(
-            routes.get("turn_webhook.webhook").startswith("/webhooks/turn/webhook")
-        )
 
-    def test_health(self):
-        """
-        Should return ok status
-        """
-        request, response = self.app.test_client.get("/webhooks/turn")
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json, {"status": "ok"})
+# Apart from its message queue, TurnInput doesn't keep any state between messages that
+# changes what it does, so all the tests can share one. Tests that change it use
+# monkeypatch, so that it's restored afterwards, and tests that use the queue use the
+# queue_input_channel fixture, which resets it
+@pytest.fixture(scope="session")
+def input_channel():
+    return TurnInput(
+        hmac_secret=None,
+        url="https://turn",
+        token="testtoken",
+        postgresql_url=None,
+        http_retries=3,
+    )
 
-    def test_validate_signature(self):
-        """
-        Should return whether a signature is valid or not
-        """
-        self.assertFalse(
-            self.input_channel.validate_signature("secret", b"payload", "aW52YWxpZA==")
-        )
-        self.assertTrue(
-            self.input_channel.validate_signature(
-                "secret", b"payload", "uC/LeRrOxXhZuYm0MKgmSIzi5Hn9+SMmvQoug3WkK6Q="
+
+@pytest.fixture(scope="module")
+def app(input_channel):
+    # configure_app is expensive, so we share a single app between all the tests
+    app = run.configure_app([input_channel])
+    app.config.ACCESS_LOG = False
+    return app
+
+
+@pytest.fixture
+def queue_input_channel(input_channel, loop):
+    """
+    The shared input channel, with its message queue stopped and cleared afterwards,
+    even if the test fails with messages still queued
+    """
+    yield input_channel
+    tasks = [*input_channel._message_workers, *input_channel._message_queue_puts]
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    input_channel._message_queue = None
+    input_channel._message_queue_closing = False
+    input_channel._message_queue_puts.clear()
+    input_channel._message_workers = []
+    input_channel._queued_messages.clear()
+
+
+@pytest.fixture
+def agent(app, monkeypatch):
+    agent = RecordingAgent()
+    monkeypatch.setattr(app, "agent", agent, raising=False)
+    return agent
+
+
+def test_from_credentials():
+    """
+    Stores the credentials on the class
+    """
+    instance = TurnInput.from_credentials(
+        {
+            "hmac_secret": "test-secret",
+            "url": "https://turn",
+            "token": "testtoken",
+            "postgresql_url": "postgresql://",
+            "http_retries": 3,
+            "message_concurrency": "10",
+            "message_queue_size": "100",
+        }
+    )
+    assert instance.hmac_secret == "test-secret"
+    assert instance.url == "https://turn"
+    assert instance.token == "testtoken"
+    assert instance.postgresql_url == "postgresql://"
+    assert instance.http_retries == 3
+    assert instance.message_concurrency == 10
+    assert instance.message_queue_size == 100
+
+    # Values that would make every webhook hang are rejected at startup
+    for credentials in ({"message_concurrency": 0}, {"message_queue_size": -1}):
+        with pytest.raises(ValueError):
+            TurnInput.from_credentials(
+                {"url": "https://turn", "token": "testtoken", **credentials}
             )
-        )
 
-    def test_webhook_invalid_signature(self):
-        """
-        Returns a 401 with an error message
-        """
-        self.input_channel = self._create_input_channel(hmac_secret="test-secret")
-        self.app = run.configure_app([self.input_channel])
 
-        request, response = self.app.test_client.post("/webhooks/turn/webhook", json={})
-        self.assertEqual(response.status_code, 401)
-        self.assertEqual(
-            response.json, {"error": "invalid_signature", "success": False}
-        )
+def test_no_credentials():
+    """
+    Raises an exception
+    """
+    with pytest.raises(Exception):
+        TurnInput.from_credentials({})
 
-        request, response = self.app.test_client.post(
-            "/webhooks/turn/webhook",
-            json={},
-            headers={"X-Turn-Hook-Signature": "aW52YWxpZA=="},
-        )
-        self.assertEqual(response.status_code, 401)
-        self.assertEqual(
-            response.json, {"error": "invalid_signature", "success": False}
-        )
 
-    def test_webhook_invalid_body(self):
-        """
-        If the body isn't a valid json object, then we should return an error message
-        """
-        request, response = self.app.test_client.post(
-            "/webhooks/turn/webhook", data="invalid"
-        )
-        self.assertEqual(response.status_code, 400)
+def test_routes(app):
+    """
+    All routes should be set up correctly
+    """
+    routes = utils.list_routes(app)
+    assert routes.get("turn_webhook.health").startswith("/webhooks/turn")
+    assert routes.get("turn_webhook.webhook").startswith("/webhooks/turn/webhook")
 
-        request, response = self.app.test_client.post(
-            "/webhooks/turn/webhook", data="[]"
-        )
-        self.assertEqual(response.status_code, 400)
-        self.assertEqual(response.json, {"error": "invalid_body", "success": False})
 
-        request, response = self.app.test_client.post(
-            "/webhooks/turn/webhook", data='{"messages": "invalid"}'
-        )
-        self.assertEqual(response.status_code, 400)
-        self.assertEqual(response.json, {"error": "invalid_body", "success": False})
+@pytest.mark.asyncio
+async def test_health(app):
+    """
+    Should return ok status
+    """
+    request, response = await app.asgi_client.get("/webhooks/turn")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
 
-    def test_webhook_handle_valid_messages(self):
-        """
-        Should process the messages
-        """
-        self.app.agent = mock.Mock()
-        request, response = self.app.test_client.post(
-            "/webhooks/turn/webhook",
-            json={
-                "messages": [
-                    {
-                        "type": "text",
-                        "text": {"body": "message body"},
-                        "from": "27820001001",
-                        "id": "message-id",
-                        "timestamp": "1518694235",
-                    }
-                ]
-            },
-            headers={"X-Turn-Claim": "conversation-claim"},
-        )
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json, {"success": True})
-
-        [call] = self.app.agent.handle_message.call_args_list
-        args, kwargs = call
-        [message] = args
-        self.assertEqual(message.text, "message body")
-        self.assertEqual(message.sender_id, "27820001001")
-        self.assertEqual(message.message_id, "message-id")
-        self.assertEqual(message.metadata, {"timestamp": "1518694235", "type": "text"})
-        self.assertEqual(
-            message.output_channel.conversation_claim, "conversation-claim"
-        )
-        self.assertEqual(message.output_channel.inbound_message_id, "message-id")
 
-    def test_webhook_handle_duplicate_messages(self):
-        """
-        Should skip processing a message if it's been processed already
-        """
-        self.app.agent = mock.Mock()
+def test_blueprint_no_hmac_secret(input_channel, caplog):
+    """
+    Warns once, when the webhook is set up, that signatures won't be validated
+    """
+    input_channel.blueprint(mock.Mock())
+    [record] = caplog.records
+    assert record.getMessage() == (
+        "hmac_secret config not set, not validating signatures"
+    )
 
-        async def fake_message_processed(sender_id, message_id):
-            return True
 
-        self.input_channel.message_processed = fake_message_processed
-        request, response = self.app.test_client.post(
-            "/webhooks/turn/webhook",
-            json={
-                "messages": [
-                    {
-                        "type": "text",
-                        "text": {"body": "message body"},
-                        "from": "27820001001",
-                        "id": "message-id",
-                        "timestamp": "1518694235",
-                    }
-                ]
-            },
-            headers={"X-Turn-Claim": "conversation-claim"},
-        )
-        self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.json, {"success": True})
-        self.app.agent.handle_message.assert_not_called()
+def test_validate_signature(input_channel):
+    """
+    Should return whether a signature is valid or not
+    """
+    assert not input_channel.validate_signature("secret", b"payload", "aW52YWxpZA==")
+    assert input_channel.validate_signature(
+        "secret", b"payload", "uC/LeRrOxXhZuYm0MKgmSIzi5Hn9+SMmvQoug3WkK6Q="
+    )
+    assert not input_channel.validate_signature("secret", b"payload", "invalid!")
+    assert not input_channel.validate_signature("secret", b"payload", "é" * 44)
 
-    def test_webhook_handle_invalid_messages(self):
-        """
-        Returns an invalid message error
-        """
-        request, response = self.app.test_client.post(
+
+def test_validate_signature_cached(input_channel):
+    """
+    Should only compute the HMAC once for the same secret, payload, and signature
+    """
+    with mock.patch(
+        "turn_rasa_connector.turn.compute_signature", return_value=b"signature"
+    ) as compute_signature:
+        for _ in range(2):
+            assert not input_channel.validate_signature(
+                "secret",
+                b"cached payload",
+                "uC/LeRrOxXhZuYm0MKgmSIzi5Hn9+SMmvQoug3WkK6Q=",
+            )
+    compute_signature.assert_called_once_with("secret", b"cached payload")
+
+
+@pytest.mark.asyncio
+async def test_validate_signature_async(input_channel, monkeypatch):
+    """
+    Should compute the HMAC of large payloads in a thread, without caching it
+    """
+    monkeypatch.setattr("turn_rasa_connector.turn.SIGNATURE_OFFLOAD_SIZE", 4)
+    signature = base64.b64decode("uC/LeRrOxXhZuYm0MKgmSIzi5Hn9+SMmvQoug3WkK6Q=")
+    assert await input_channel.validate_signature_async("secret", b"payload", signature)
+    assert not await input_channel.validate_signature_async(
+        "secret", b"other payload", signature
+    )
+    with mock.patch(
+        "turn_rasa_connector.turn.compute_signature", return_value=b"signature"
+    ) as compute_signature:
+        for _ in range(2):
+            await input_channel.validate_signature_async(
+                "secret", b"payload", signature
+            )
+    assert compute_signature.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_webhook_invalid_signature(app, input_channel, monkeypatch):
+    """
+    Returns a 401 with an error message
+    """
+    # The webhook reads the secret on each request, so we don't need a new app
+    monkeypatch.setattr(input_channel, "hmac_secret", "test-secret")
+
+    request, response = await app.asgi_client.post("/webhooks/turn/webhook", json={})
+    assert response.status_code == 401
+    assert response.json() == {"error": "invalid_signature", "success": False}
+
+    request, response = await app.asgi_client.post(
+        "/webhooks/turn/webhook",
+        json={},
+        headers={"X-Turn-Hook-Signature": "aW52YWxpZA=="},
+    )
+    assert response.status_code == 401
+    assert response.json() == {"error": "invalid_signature", "success": False}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "body", ["invalid", "[]", '{"messages": "invalid"}', '{"messages": ', " {} []"]
+)
+async def test_webhook_invalid_body(app, body):
+    """
+    If the body isn't a valid json object, then we should return an error message
+    """
+    request, response = await app.asgi_client.post("/webhooks/turn/webhook", data=body)
+    assert response.status_code == 400
+    assert response.json() == {"error": "invalid_body", "success": False}
+
+
+@pytest.mark.asyncio
+async def test_webhook_handle_valid_messages(app, agent):
+    """
+    Should process the messages
+    """
+    request, response = await app.asgi_client.post(
+        "/webhooks/turn/webhook",
+        data=TEXT_MESSAGE_BODY,
+        headers={
+            "Content-Type": "application/json",
+            "X-Turn-Claim": "conversation-claim",
+        },
+    )
+    assert response.status_code == 200
+    assert response.json() == {"success": True}
+
+    [(message, kwargs)] = agent.calls
+    assert message.text == "message body"
+    assert message.sender_id == "27820001001"
+    assert message.message_id == "message-id"
+    assert message.metadata == {"timestamp": "1518694235", "type": "text"}
+    assert message.output_channel.conversation_claim == "conversation-claim"
+    assert message.output_channel.inbound_message_id == "message-id"
+
+
+@pytest.mark.asyncio
+async def test_webhook_handle_duplicate_messages(
+    app, agent, input_channel, monkeypatch
+):
+    """
+    Should skip processing a message if it's been processed already
+    """
+
+    async def fake_messages_processed(messages):
+        return {("27820001001", "message-id")}
+
+    monkeypatch.setattr(input_channel, "messages_processed", fake_messages_processed)
+    request, response = await app.asgi_client.post(
+        "/webhooks/turn/webhook",
+        data=TEXT_MESSAGE_BODY,
+        headers={
+            "Content-Type": "application/json",
+            "X-Turn-Claim": "conversation-claim",
+        },
+    )
+    assert response.status_code == 200
+    assert response.json() == {"success": True}
+    assert agent.calls == []
+
+
+@pytest.mark.asyncio
+async def test_webhook_handle_message_error(app, agent, monkeypatch):
+    """
+    Errors handling a message shouldn't stop the other messages from being handled
+    """
+
+    async def handle_message(message, **kwargs):
+        agent.calls.append((message, kwargs))
+        if message.message_id == "message-id-1":
+            raise Exception("test error")
+
+    monkeypatch.setattr(agent, "handle_message", handle_message)
+    messages = [
+        {
+            "type": "text",
+            "text": {"body": "message body"},
+            "from": "27820001001",
+            "id": f"message-id-{i}",
+            "timestamp": "1518694235",
+        }
+        for i in range(1, 3)
+    ]
+    request, response = await app.asgi_client.post(
+        "/webhooks/turn/webhook", json={"messages": messages}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"success": True}
+    assert sorted(m.message_id for m, _ in agent.calls) == [
+        "message-id-1",
+        "message-id-2",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_webhook_handle_messages_concurrently(
+    app, agent, input_channel, monkeypatch
+):
+    """
+    Should handle the messages in a batch concurrently, up to the concurrency limit
+    """
+    running = 0
+    max_running = 0
+
+    async def handle_message(message, **kwargs):
+        nonlocal running, max_running
+        agent.calls.append((message, kwargs))
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    monkeypatch.setattr(agent, "handle_message", handle_message)
+    monkeypatch.setattr(input_channel, "message_concurrency", 3)
+    messages = [
+        {
+            "type": "text",
+            "text": {"body": "message body"},
+            "from": "27820001001",
+            "id": f"message-id-{i}",
+            "timestamp": "1518694235",
+        }
+        for i in range(10)
+    ]
+    request, response = await app.asgi_client.post(
+        "/webhooks/turn/webhook", json={"messages": messages}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"success": True}
+    assert len(agent.calls) == 10
+    assert max_running == 3
+
+
+@pytest.mark.asyncio
+async def test_webhook_queue_messages(app, queue_input_channel, monkeypatch):
+    """
+    If message_queue_size is set, should respond before the messages are handled, and
+    handle them all before stopping
+    """
+    handled = []
+    release = asyncio.Event()
+
+    async def on_new_message(message):
+        await release.wait()
+        handled.append(message)
+
+    monkeypatch.setattr(queue_input_channel, "message_queue_size", 10)
+    await queue_input_channel.start_message_workers(on_new_message)
+    try:
+        request, response = await app.asgi_client.post(
             "/webhooks/turn/webhook",
-            json={"messages": [{"type": "invalid"}]},
+            data=TEXT_MESSAGE_BODY,
+            headers={"Content-Type": "application/json"},
         )
-        self.assertEqual(response.status_code, 400)
-        self.assertEqual(response.json, {"success": False, "error": "invalid_message"})
+        assert response.status_code == 200
+        assert response.json() == {"success": True}
+        assert handled == []
+    finally:
+        release.set()
+        await queue_input_channel.stop_message_workers()
 
-    def test_handle_audio(self):
-        """
-        Returns a UserMesssage with valid parameters
-        """
-        message = self.input_channel.extract_message(
-            {
-                "from": "27820001001",
-                "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
-                "audio": {
-                    "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
-                    "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
-                    "mime_type": "audio/mpeg",
-                    "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
-                },
-                "timestamp": "1521497954",
-                "type": "audio",
-            }
+    [message] = handled
+    assert message.message_id == "message-id"
+
+
+@pytest.mark.asyncio
+async def test_webhook_queue_messages_redelivered(
+    app, queue_input_channel, monkeypatch
+):
+    """
+    Should skip messages that are redelivered while they're still queued, since they
+    aren't in the tracker store yet
+    """
+    handled = []
+    release = asyncio.Event()
+
+    async def on_new_message(message):
+        await release.wait()
+        handled.append(message.message_id)
+
+    monkeypatch.setattr(queue_input_channel, "message_queue_size", 10)
+    await queue_input_channel.start_message_workers(on_new_message)
+    try:
+        for _ in range(2):
+            request, response = await app.asgi_client.post(
+                "/webhooks/turn/webhook",
+                data=TEXT_MESSAGE_BODY,
+                headers={"Content-Type": "application/json"},
+            )
+            assert response.status_code == 200
+    finally:
+        release.set()
+        await queue_input_channel.stop_message_workers()
+
+    assert handled == ["message-id"]
+    assert queue_input_channel._queued_messages == set()
+
+
+@pytest.mark.asyncio
+async def test_webhook_queue_messages_stop(app, queue_input_channel, monkeypatch):
+    """
+    If the workers stop while a webhook is waiting for space in the queue, the
+    webhook should still succeed, and all of its messages should be handled
+    """
+    handled = []
+    release = asyncio.Event()
+
+    async def on_new_message(message):
+        await release.wait()
+        handled.append(message.message_id)
+
+    body = orjson.dumps(
+        {
+            "messages": [
+                {
+                    "type": "text",
+                    "text": {"body": "message body"},
+                    "from": "27820001001",
+                    "id": f"message-id-{i}",
+                    "timestamp": "1518694235",
+                }
+                for i in range(3)
+            ]
+        }
+    )
+    monkeypatch.setattr(queue_input_channel, "message_queue_size", 1)
+    monkeypatch.setattr(queue_input_channel, "message_concurrency", 1)
+    await queue_input_channel.start_message_workers(on_new_message)
+    try:
+        webhook = asyncio.ensure_future(
+            app.asgi_client.post(
+                "/webhooks/turn/webhook",
+                data=body,
+                headers={"Content-Type": "application/json"},
+            )
         )
-        self.assertEqual(message.text, "")
-        self.assertEqual(message.sender_id, "27820001001")
-        self.assertEqual(message.message_id, "ABGGFlA5FpafAgo6tHcNmNjXmuSf")
-        self.assertEqual(
-            message.metadata,
-            {
-                "audio": {
-                    "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
-                    "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
-                    "mime_type": "audio/mpeg",
-                    "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
-                },
-                "timestamp": "1521497954",
-                "type": "audio",
+        # One message is with the worker, one is queued, and the webhook is waiting
+        # to queue the last one
+        while not queue_input_channel._message_queue.full():
+            await asyncio.sleep(0.01)
+        stop = asyncio.ensure_future(queue_input_channel.stop_message_workers())
+        await asyncio.sleep(0.01)
+        assert not stop.done()
+    finally:
+        release.set()
+
+    request, response = await webhook
+    await stop
+    assert response.status_code == 200
+    assert sorted(handled) == [f"message-id-{i}" for i in range(3)]
+
+
+@pytest.mark.asyncio
+async def test_webhook_handle_invalid_messages(app):
+    """
+    Returns an invalid message error
+    """
+    request, response = await app.asgi_client.post(
+        "/webhooks/turn/webhook",
+        json={"messages": [{"type": "invalid"}]},
+    )
+    assert response.status_code == 400
+    assert response.json() == {"success": False, "error": "invalid_message"}
+
+
+def test_handle_audio(input_channel):
+    """
+    Returns a UserMesssage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "from": "27820001001",
+            "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+            "audio": {
+                "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
+                "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
+                "mime_type": "audio/mpeg",
+                "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
             },
-        )
+            "timestamp": "1521497954",
+            "type": "audio",
+        }
+    )
+    assert message.text == ""
+    assert message.sender_id == "27820001001"
+    assert message.message_id == "ABGGFlA5FpafAgo6tHcNmNjXmuSf"
+    assert message.metadata == {
+        "audio": {
+            "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
+            "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
+            "mime_type": "audio/mpeg",
+            "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
+        },
+        "timestamp": "1521497954",
+        "type": "audio",
+    }
 
-    def test_handle_document(self):
-        """
-        Returns a UserMessage with valid parameters
-        """
-        message = self.input_channel.extract_message(
-            {
-                "from": "27820001001",
-                "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
-                "timestamp": "1522189546",
-                "type": "document",
-                "document": {
-                    "caption": "80skaraokesonglistartist",
-                    "file": "/usr/local/wamedia/shared/fc233119-733f-49c-bcbd-b2f68f79",
-                    "id": "fc233119-733f-49c-bcbd-b2f68f798e33",
-                    "mime_type": "application/pdf",
-                    "sha256": "3b11fa6ef2bde1dd14726e09d3edaf782120919d06f6484f32d5d5c",
-                },
-            }
-        )
-        self.assertEqual(message.text, "80skaraokesonglistartist")
-        self.assertEqual(message.sender_id, "27820001001")
-        self.assertEqual(message.message_id, "ABGGFlA5FpafAgo6tHcNmNjXmuSf")
-        self.assertEqual(
-            message.metadata,
-            {
-                "document": {
-                    "file": "/usr/local/wamedia/shared/fc233119-733f-49c-bcbd-b2f68f79",
-                    "id": "fc233119-733f-49c-bcbd-b2f68f798e33",
-                    "mime_type": "application/pdf",
-                    "sha256": "3b11fa6ef2bde1dd14726e09d3edaf782120919d06f6484f32d5d5c",
-                },
-                "timestamp": "1522189546",
-                "type": "document",
+
+def test_handle_document(input_channel):
+    """
+    Returns a UserMessage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "from": "27820001001",
+            "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+            "timestamp": "1522189546",
+            "type": "document",
+            "document": {
+                "caption": "80skaraokesonglistartist",
+                "file": "/usr/local/wamedia/shared/fc233119-733f-49c-bcbd-b2f68f79",
+                "id": "fc233119-733f-49c-bcbd-b2f68f798e33",
+                "mime_type": "application/pdf",
+                "sha256": "3b11fa6ef2bde1dd14726e09d3edaf782120919d06f6484f32d5d5c",
             },
-        )
+        }
+    )
+    assert message.text == "80skaraokesonglistartist"
+    assert message.sender_id == "27820001001"
+    assert message.message_id == "ABGGFlA5FpafAgo6tHcNmNjXmuSf"
+    assert message.metadata == {
+        "document": {
+            "file": "/usr/local/wamedia/shared/fc233119-733f-49c-bcbd-b2f68f79",
+            "id": "fc233119-733f-49c-bcbd-b2f68f798e33",
+            "mime_type": "application/pdf",
+            "sha256": "3b11fa6ef2bde1dd14726e09d3edaf782120919d06f6484f32d5d5c",
+        },
+        "timestamp": "1522189546",
+        "type": "document",
+    }
 
-    def test_handle_image(self):
-        """
-        Returns a UserMessage with valid parameters
-        """
-        message = self.input_channel.extract_message(
-            {
-                "from": "27820001001",
-                "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
-                "image": {
-                    "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
-                    "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
-                    "mime_type": "image/jpeg",
-                    "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
-                    "caption": "Check out my new phone!",
-                },
-                "timestamp": "1521497954",
-                "type": "image",
-            }
-        )
-        self.assertEqual(message.text, "Check out my new phone!")
-        self.assertEqual(message.sender_id, "27820001001")
-        self.assertEqual(message.message_id, "ABGGFlA5FpafAgo6tHcNmNjXmuSf")
-        self.assertEqual(
-            message.metadata,
-            {
-                "image": {
-                    "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
-                    "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
-                    "mime_type": "image/jpeg",
-                    "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
-                },
-                "timestamp": "1521497954",
-                "type": "image",
+
+def test_handle_image(input_channel):
+    """
+    Returns a UserMessage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "from": "27820001001",
+            "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+            "image": {
+                "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
+                "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
+                "mime_type": "image/jpeg",
+                "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
+                "caption": "Check out my new phone!",
             },
-        )
+            "timestamp": "1521497954",
+            "type": "image",
+        }
+    )
+    assert message.text == "Check out my new phone!"
+    assert message.sender_id == "27820001001"
+    assert message.message_id == "ABGGFlA5FpafAgo6tHcNmNjXmuSf"
+    assert message.metadata == {
+        "image": {
+            "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
+            "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
+            "mime_type": "image/jpeg",
+            "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
+        },
+        "timestamp": "1521497954",
+        "type": "image",
+    }
 
-    def test_handle_video(self):
-        """
-        Returns a UserMessage with valid parameters
-        """
-        message = self.input_channel.extract_message(
-            {
-                "from": "27820001001",
-                "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
-                "video": {
-                    "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
-                    "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
-                    "mime_type": "video/mp4",
-                    "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
-                    "caption": "Check out my new phone!",
-                },
-                "timestamp": "1521497954",
-                "type": "video",
-            }
-        )
-        self.assertEqual(message.text, "Check out my new phone!")
-        self.assertEqual(message.sender_id, "27820001001")
-        self.assertEqual(message.message_id, "ABGGFlA5FpafAgo6tHcNmNjXmuSf")
-        self.assertEqual(
-            message.metadata,
-            {
-                "video": {
-                    "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
-                    "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
-                    "mime_type": "video/mp4",
-                    "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
-                },
-                "timestamp": "1521497954",
-                "type": "video",
+
+def test_handle_video(input_channel):
+    """
+    Returns a UserMessage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "from": "27820001001",
+            "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+            "video": {
+                "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
+                "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
+                "mime_type": "video/mp4",
+                "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
+                "caption": "Check out my new phone!",
             },
-        )
+            "timestamp": "1521497954",
+            "type": "video",
+        }
+    )
+    assert message.text == "Check out my new phone!"
+    assert message.sender_id == "27820001001"
+    assert message.message_id == "ABGGFlA5FpafAgo6tHcNmNjXmuSf"
+    assert message.metadata == {
+        "video": {
+            "file": "/usr/local/wamedia/shared/b1cf38-8734-4ad3-b4a1-ef0c10d0d",
+            "id": "b1c68f38-8734-4ad3-b4a1-ef0c10d683",
+            "mime_type": "video/mp4",
+            "sha256": "29ed500fa64eb55fc19dc4124acb300e5dcc54a0f822a301ae99944",
+        },
+        "timestamp": "1521497954",
+        "type": "video",
+    }
 
-    def test_handle_voice(self):
-        """
-        Returns a UserMessage with valid parameters
-        """
-        message = self.input_channel.extract_message(
-            {
-                "from": "27820001001",
-                "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
-                "timestamp": "1521827831",
-                "type": "voice",
-                "voice": {
-                    "file": "/usr/local/wamedia/shared/463e/b7ec/ff4e4d9bb1101879cbd41",
-                    "id": "463eb7ec-ff4e-4d9b-b110-1879cbd411b2",
-                    "mime_type": "audio/ogg; codecs=opus",
-                    "sha256": "fa9e1807d936b7cebe63654ea3a7912b1fa9479220258d823590521",
-                },
-            }
-        )
-        self.assertEqual(message.text, "")
-        self.assertEqual(message.sender_id, "27820001001")
-        self.assertEqual(message.message_id, "ABGGFlA5FpafAgo6tHcNmNjXmuSf")
-        self.assertEqual(
-            message.metadata,
-            {
-                "voice": {
-                    "file": "/usr/local/wamedia/shared/463e/b7ec/ff4e4d9bb1101879cbd41",
-                    "id": "463eb7ec-ff4e-4d9b-b110-1879cbd411b2",
-                    "mime_type": "audio/ogg; codecs=opus",
-                    "sha256": "fa9e1807d936b7cebe63654ea3a7912b1fa9479220258d823590521",
-                },
-                "timestamp": "1521827831",
-                "type": "voice",
+
+def test_handle_voice(input_channel):
+    """
+    Returns a UserMessage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "from": "27820001001",
+            "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+            "timestamp": "1521827831",
+            "type": "voice",
+            "voice": {
+                "file": "/usr/local/wamedia/shared/463e/b7ec/ff4e4d9bb1101879cbd41",
+                "id": "463eb7ec-ff4e-4d9b-b110-1879cbd411b2",
+                "mime_type": "audio/ogg; codecs=opus",
+                "sha256": "fa9e1807d936b7cebe63654ea3a7912b1fa9479220258d823590521",
             },
-        )
+        }
+    )
+    assert message.text == ""
+    assert message.sender_id == "27820001001"
+    assert message.message_id == "ABGGFlA5FpafAgo6tHcNmNjXmuSf"
+    assert message.metadata == {
+        "voice": {
+            "file": "/usr/local/wamedia/shared/463e/b7ec/ff4e4d9bb1101879cbd41",
+            "id": "463eb7ec-ff4e-4d9b-b110-1879cbd411b2",
+            "mime_type": "audio/ogg; codecs=opus",
+            "sha256": "fa9e1807d936b7cebe63654ea3a7912b1fa9479220258d823590521",
+        },
+        "timestamp": "1521827831",
+        "type": "voice",
+    }
 
-    def test_handle_contacts(self):
-        """
-        Returns a UserMessage with valid parameters
-        """
-        message = self.input_channel.extract_message(
+
+def test_handle_contacts(input_channel):
+    """
+    Returns a UserMessage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "contacts": [
+                {
+                    "addresses": [
+                        {
+                            "city": "Menlo Park",
+                            "country": "United States",
+                            "country_code": "us",
+                            "state": "CA",
+                            "street": "1 Hacker Way",
+                            "type": "WORK",
+                            "zip": "94025",
+                        }
+                    ],
+                    "birthday": "2012-08-18",
+                    "contact_image": "/9j/4AAQSkZJRgABAQEAZABkAAD/2wBDAAgGBgcGBQgH",
+                    "emails": [{"email": "kfish@fb.com", "type": "WORK"}],
+                    "ims": [{"service": "AIM", "user_id": "kfish"}],
+                    "name": {
+                        "first_name": "Kerry",
+                        "formatted_name": "Kerry Fisher",
+                        "last_name": "Fisher",
+                    },
+                    "org": {"company": "Facebook"},
+                    "phones": [
+                        {"phone": "+1 (940) 555-1234", "type": "CELL"},
+                        {
+                            "phone": "+1 (650) 555-1234",
+                            "type": "WORK",
+                            "wa_id": "16505551234",
+                        },
+                    ],
+                    "urls": [{"url": "https://www.facebook.com", "type": "WORK"}],
+                }
+            ],
+            "from": "16505551234",
+            "id": "ABGGFlA4dSRvAgo6C4Z53hMh1ugR",
+            "timestamp": "1537248012",
+            "type": "contacts",
+        }
+    )
+    assert message.text == ""
+    assert message.sender_id == "16505551234"
+    assert message.message_id == "ABGGFlA4dSRvAgo6C4Z53hMh1ugR"
+    assert message.metadata == {
+        "contacts": [
             {
-                "contacts": [
+                "addresses": [
                     {
-                        "addresses": [
-                            {
-                                "city": "Menlo Park",
-                                "country": "United States",
-                                "country_code": "us",
-                                "state": "CA",
-                                "street": "1 Hacker Way",
-                                "type": "WORK",
-                                "zip": "94025",
-                            }
-                        ],
-                        "birthday": "2012-08-18",
-                        "contact_image": "/9j/4AAQSkZJRgABAQEAZABkAAD/2wBDAAgGBgcGBQgH",
-                        "emails": [{"email": "kfish@fb.com", "type": "WORK"}],
-                        "ims": [{"service": "AIM", "user_id": "kfish"}],
-                        "name": {
-                            "first_name": "Kerry",
-                            "formatted_name": "Kerry Fisher",
-                            "last_name": "Fisher",
-                        },
-                        "org": {"company": "Facebook"},
-                        "phones": [
-                            {"phone": "+1 (940) 555-1234", "type": "CELL"},
-                            {
-                                "phone": "+1 (650) 555-1234",
-                                "type": "WORK",
-                                "wa_id": "16505551234",
-                            },
-                        ],
-                        "urls": [{"url": "https://www.facebook.com", "type": "WORK"}],
+                        "city": "Menlo Park",
+                        "country": "United States",
+                        "country_code": "us",
+                        "state": "CA",
+                        "street": "1 Hacker Way",
+                        "type": "WORK",
+                        "zip": "94025",
                     }
                 ],
-                "from": "16505551234",
-                "id": "ABGGFlA4dSRvAgo6C4Z53hMh1ugR",
-                "timestamp": "1537248012",
-                "type": "contacts",
-            }
-        )
-        self.assertEqual(message.text, "")
-        self.assertEqual(message.sender_id, "16505551234")
-        self.assertEqual(message.message_id, "ABGGFlA4dSRvAgo6C4Z53hMh1ugR")
-        self.assertEqual(
-            message.metadata,
-            {
-                "contacts": [
+                "birthday": "2012-08-18",
+                "contact_image": "/9j/4AAQSkZJRgABAQEAZABkAAD/2wBDAAgGBgcGBQgH",
+                "emails": [{"email": "kfish@fb.com", "type": "WORK"}],
+                "ims": [{"service": "AIM", "user_id": "kfish"}],
+                "name": {
+                    "first_name": "Kerry",
+                    "formatted_name": "Kerry Fisher",
+                    "last_name": "Fisher",
+                },
+                "org": {"company": "Facebook"},
+                "phones": [
+                    {"phone": "+1 (940) 555-1234", "type": "CELL"},
                     {
-                        "addresses": [
-                            {
-                                "city": "Menlo Park",
-                                "country": "United States",
-                                "country_code": "us",
-                                "state": "CA",
-                                "street": "1 Hacker Way",
-                                "type": "WORK",
-                                "zip": "94025",
-                            }
-                        ],
-                        "birthday": "2012-08-18",
-                        "contact_image": "/9j/4AAQSkZJRgABAQEAZABkAAD/2wBDAAgGBgcGBQgH",
-                        "emails": [{"email": "kfish@fb.com", "type": "WORK"}],
-                        "ims": [{"service": "AIM", "user_id": "kfish"}],
-                        "name": {
-                            "first_name": "Kerry",
-                            "formatted_name": "Kerry Fisher",
-                            "last_name": "Fisher",
-                        },
-                        "org": {"company": "Facebook"},
-                        "phones": [
-                            {"phone": "+1 (940) 555-1234", "type": "CELL"},
-                            {
-                                "phone": "+1 (650) 555-1234",
-                                "type": "WORK",
-                                "wa_id": "16505551234",
-                            },
-                        ],
-                        "urls": [{"url": "https://www.facebook.com", "type": "WORK"}],
-                    }
+                        "phone": "+1 (650) 555-1234",
+                        "type": "WORK",
+                        "wa_id": "16505551234",
+                    },
                 ],
-                "timestamp": "1537248012",
-                "type": "contacts",
+                "urls": [{"url": "https://www.facebook.com", "type": "WORK"}],
+            }
+        ],
+        "timestamp": "1537248012",
+        "type": "contacts",
+    }
+
+
+def test_handle_location(input_channel):
+    """
+    Returns a UserMessage with valid parameters
+    """
+    message = input_channel.extract_message(
+        {
+            "from": "16315551234",
+            "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
+            "location": {
+                "address": "Main Street Beach, Santa Cruz, CA",
+                "latitude": 38.9806263495,
+                "longitude": -131.9428612257,
+                "name": "Main Street Beach",
+                "url": "https://foursquare.com/v/4d7031d35b5df7744",
             },
-        )
+            "timestamp": "1521497875",
+            "type": "location",
+        }
+    )
+    assert message.text == ""
+    assert message.sender_id == "16315551234"
+    assert message.message_id == "ABGGFlA5FpafAgo6tHcNmNjXmuSf"
+    assert message.metadata == {
+        "location": {
+            "address": "Main Street Beach, Santa Cruz, CA",
+            "latitude": 38.9806263495,
+            "longitude": -131.9428612257,
+            "name": "Main Street Beach",
+            "url": "https://foursquare.com/v/4d7031d35b5df7744",
+        },
+        "timestamp": "1521497875",
+        "type": "location",
+    }
 
-    def test_handle_location(self):
-        """
-        Returns a UserMessage with valid parameters
-        """
-        message = self.input_channel.extract_message(
-            {
-                "from": "16315551234",
-                "id": "ABGGFlA5FpafAgo6tHcNmNjXmuSf",
-                "location": {
-                    "address": "Main Street Beach, Santa Cruz, CA",
-                    "latitude": 38.9806263495,
-                    "longitude": -131.9428612257,
-                    "name": "Main Street Beach",
-                    "url": "https://foursquare.com/v/4d7031d35b5df7744",
-                },
-                "timestamp": "1521497875",
-                "type": "location",
-            }
+
+def test_handle_subclass():
+    """
+    Subclasses should be able to override handlers, and add new ones
+    """
+
+    class CustomTurnInput(TurnInput):
+        def handle_text(self, message):
+            return self.handle_common("overridden", message)
+
+        def handle_sticker(self, message):
+            return self.handle_common("sticker", message)
+
+    input_channel = CustomTurnInput(None, "https://turn", "testtoken", None, 3)
+    for message_type, text in (("text", "overridden"), ("sticker", "sticker")):
+        message = input_channel.extract_message(
+            {"type": message_type, "from": "27820001001", "id": "message-id"}
         )
-        self.assertEqual(message.text, "")
-        self.assertEqual(message.sender_id, "16315551234")
-        self.assertEqual(message.message_id, "ABGGFlA5FpafAgo6tHcNmNjXmuSf")
-        self.assertEqual(
-            message.metadata,
-            {
-                "location": {
-                    "address": "Main Street Beach, Santa Cruz, CA",
-                    "latitude": 38.9806263495,
-                    "longitude": -131.9428612257,
-                    "name": "Main Street Beach",
-                    "url": "https://foursquare.com/v/4d7031d35b5df7744",
-                },
-                "timestamp": "1521497875",
-                "type": "location",
-            },
+        assert message.text == text
+    with pytest.raises(AttributeError):
+        input_channel.extract_message(
+            {"type": "invalid", "from": "27820001001", "id": "message-id"}
         )
 
 
@@ -526,13 +833,39 @@ def test_output_channel_name():
     assert output_channel.name() == "turn"
 
 
-@pytest.fixture
-def turn_mock_server(loop, sanic_client):
+def test_retry_backoff():
+    """
+    Should wait a random time up to an exponentially growing, capped, limit
+    """
+    for attempt, limit in [(0, 0.05), (1, 0.1), (2, 0.2), (10, 1.0)]:
+        for _ in range(100):
+            assert 0 <= retry_backoff(attempt) <= limit
+
+
+@pytest.fixture(scope="module")
+def loop():
+    # pytest-sanic and pytest-asyncio share this loop, so that the mock Turn server
+    # can be started once for the module, and still serve every test
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+def event_loop(loop):
+    return loop
+
+
+@pytest.fixture(scope="module")
+def mock_turn_server(loop):
     app = Sanic("mock_turn")
+    app.config.ACCESS_LOG = False
     app.messages = []
     app.automation_messages = []
     app.media = []
     app.failures = []
+    app.slow = []
 
     @app.route("/v1/messages", methods=["POST"])
     async def messages(request):
@@ -553,6 +886,33 @@ def turn_mock_server(loop, sanic_client):
     async def images(request, image):
         return response.raw(b"testimagecontent", content_type="image/jpeg")
 
+    @app.route("/uncacheable/<image>", methods=["GET"])
+    async def uncacheable_images(request, image):
+        return response.raw(
+            b"testimagecontent",
+            content_type="image/jpeg",
+            headers={"Cache-Control": "no-store"},
+        )
+
+    @app.route("/slow/<image>", methods=["GET"])
+    async def slow_images(request, image):
+        # Held until the test sets app.slow_release
+        app.slow.append(request)
+        await app.slow_release.wait()
+        return response.raw(
+            b"testimagecontent",
+            content_type="image/jpeg",
+            headers={"Cache-Control": "max-age=600"},
+        )
+
+    @app.route("/streamed/<image>", methods=["GET"])
+    async def streamed_images(request, image):
+        async def stream(response):
+            await response.write(b"testimage")
+            await response.write(b"content")
+
+        return response.stream(stream, content_type="image/jpeg")
+
     @app.route("/documents/<document>", methods=["GET"])
     async def documents(request, document):
         return response.raw(b"testdocumentcontent", content_type="application/pdf")
@@ -562,12 +922,37 @@ def turn_mock_server(loop, sanic_client):
         app.failures.append(request)
         raise sanic_exceptions.ServerError("error")
 
+    @app.route("/invalid/<ignored>", methods=["GET"])
+    async def invalid(request, ignored):
+        app.failures.append(request)
+        raise sanic_exceptions.NotFound("not found")
+
     @app.route("/failure/v1/messages", methods=["POST"])
     async def message_failure(request):
         app.failures.append(request)
         raise sanic_exceptions.ServerError("error")
 
-    return loop.run_until_complete(sanic_client(app))
+    server = pytest_sanic_utils.TestServer(app)
+    loop.run_until_complete(server.start_server())
+    yield server
+    loop.run_until_complete(server.close())
+
+
+@pytest.fixture
+def turn_mock_server(mock_turn_server):
+    # Clear out the requests and uploaded media from previous tests. The server keeps
+    # the same port for the whole module, so the media URLs would still be cached
+    media_cache.clear()
+    app = mock_turn_server.app
+    for requests in (
+        app.messages,
+        app.automation_messages,
+        app.media,
+        app.failures,
+        app.slow,
+    ):
+        requests.clear()
+    return mock_turn_server
 
 
 @pytest.mark.asyncio
@@ -637,7 +1022,7 @@ async def test_release_conversation_claim(turn_mock_server: Sanic):
     )
     [message] = turn_mock_server.app.messages
     assert message.headers["X-Turn-Claim-Release"] == "conversation-claim-id"
-    assert message.headers["Content-Length"] == "71"
+    assert message.headers["Content-Length"] == "65"
 
 
 @pytest.mark.asyncio
@@ -702,6 +1087,59 @@ async def test_send_image_message(turn_mock_server: Sanic):
     assert len(turn_mock_server.app.media) == 1
 
 
+@pytest.mark.asyncio
+async def test_send_image_message_uncacheable(turn_mock_server: Sanic):
+    """
+    Uploads the media again for every message, if its caching headers don't allow it
+    to be reused
+    """
+    output_channel = TurnOutput(
+        url=f"http://{turn_mock_server.host}:{turn_mock_server.port}", token="testtoken"
+    )
+    for _ in range(2):
+        await output_channel.send_response(
+            "27820001001",
+            {
+                "image": f"http://{turn_mock_server.host}:{turn_mock_server.port}"
+                "/uncacheable/image.jpg"
+            },
+        )
+    assert len(turn_mock_server.app.media) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("path", ["/images/large.jpg", "/streamed/large.jpg"])
+async def test_send_image_message_too_large(turn_mock_server: Sanic, monkeypatch, path):
+    """
+    Doesn't send media larger than MEDIA_MAX_SIZE, whether or not the media's size is
+    known upfront
+    """
+    monkeypatch.setattr("turn_rasa_connector.turn.MEDIA_MAX_SIZE", 8)
+    output_channel = TurnOutput(
+        url=f"http://{turn_mock_server.host}:{turn_mock_server.port}", token="testtoken"
+    )
+    with pytest.raises(ValueError):
+        await output_channel.send_response(
+            "27820001001",
+            {"image": f"http://{turn_mock_server.host}:{turn_mock_server.port}{path}"},
+        )
+    assert turn_mock_server.app.messages == []
+
+
+def test_get_max_age():
+    """
+    Should return how long the Cache-Control header allows the media to be reused for
+    """
+    assert get_max_age(None) is None
+    assert get_max_age("public") is None
+    assert get_max_age("public, max-age=600") == 600
+    assert get_max_age("Max-Age=60") == 60
+    assert get_max_age("max-age=invalid") is None
+    assert get_max_age("max-age=600, no-cache") == 0
+    assert get_max_age("no-cache, max-age=600") == 0
+    assert get_max_age("no-store") == 0
+
+
 @pytest.mark.asyncio
 async def test_send_document_message(turn_mock_server: Sanic):
     """
@@ -792,6 +1230,76 @@ async def test_send_image_message_failure(turn_mock_server: Sanic):
     assert len(turn_mock_server.app.failures) == 3
 
 
+@pytest.mark.asyncio
+async def test_send_image_message_client_error(turn_mock_server: Sanic):
+    """
+    Doesn't retry client errors, since they'll fail the same way every time
+    """
+    output_channel = TurnOutput(
+        url=f"http://{turn_mock_server.host}:{turn_mock_server.port}", token="testtoken"
+    )
+    with pytest.raises(httpx.HTTPError):
+        await output_channel.send_response(
+            "27820001001",
+            {
+                "image": f"http://{turn_mock_server.host}:{turn_mock_server.port}"
+                "/invalid/image.png",
+            },
+        )
+    assert len(turn_mock_server.app.failures) == 1
+
+
+@pytest.mark.asyncio
+async def test_send_image_message_failure_not_cached(turn_mock_server: Sanic):
+    """
+    Tries to upload the media again on the next message, if the upload failed
+    """
+    output_channel = TurnOutput(
+        url=f"http://{turn_mock_server.host}:{turn_mock_server.port}", token="testtoken"
+    )
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPError):
+            await output_channel.send_response(
+                "27820001001",
+                {
+                    "image": f"http://{turn_mock_server.host}:{turn_mock_server.port}"
+                    "/failure/uncached.png",
+                },
+            )
+    assert len(turn_mock_server.app.failures) == 6
+
+
+@pytest.mark.asyncio
+async def test_send_image_message_cancelled(turn_mock_server: Sanic):
+    """
+    If the caller that started an upload is cancelled, the upload should carry on,
+    and still be cached with the media's max age
+    """
+    turn_mock_server.app.slow_release = asyncio.Event()
+    output_channel = TurnOutput(
+        url=f"http://{turn_mock_server.host}:{turn_mock_server.port}", token="testtoken"
+    )
+    message = {
+        "image": f"http://{turn_mock_server.host}:{turn_mock_server.port}"
+        "/slow/image.jpg"
+    }
+    task = asyncio.ensure_future(
+        output_channel.send_response("27820001001", dict(message))
+    )
+    while not turn_mock_server.app.slow:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    turn_mock_server.app.slow_release.set()
+    for _ in range(2):
+        await output_channel.send_response("27820001001", dict(message))
+    assert len(turn_mock_server.app.media) == 1
+    [(expiry, _)] = media_cache.values()
+    assert expiry <= time.monotonic() + 600
+
+
 @pytest.mark.asyncio
 async def test_send_text_with_buttons_message(turn_mock_server: Sanic):
     """
@@ -871,6 +1379,20 @@ async def test_postgresql_pool():
     input_channel = TurnInput(None, None, None, POSTGRESQL_URL, None)
     pool = await input_channel.get_postgresql_pool()
     assert isinstance(pool, asyncpg.pool.Pool)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_postgresql_pool_concurrent():
+    """
+    Concurrent messages should share a single postgresql pool
+    """
+    input_channel = TurnInput(None, None, None, POSTGRESQL_URL, None)
+    pool1, pool2 = await asyncio.gather(
+        input_channel.get_postgresql_pool(), input_channel.get_postgresql_pool()
+    )
+    assert pool1 is pool2
+    await pool1.close()
 
 
 @pytest.mark.asyncio
@@ -929,6 +1451,16 @@ async def test_message_processed():
     result = await input_channel.message_processed("27820001001", "test-message-id")
     assert result is True
 
+    # Checking a batch should only return the messages that were processed
+    result = await input_channel.messages_processed(
+        [
+            ("27820001001", "test-message-id"),
+            ("27820001001", "other-message-id"),
+            ("27820001002", "test-message-id"),
+        ]
+    )
+    assert result == {("27820001001", "test-message-id")}
+
     # Rollback any changes we made in the test
     await transaction.rollback()
     await conn.close()
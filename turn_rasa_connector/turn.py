@@ -1,28 +1,65 @@
-import base64
+import binascii
+import hashlib
 import hmac
-import json
 import logging
+import math
 import os
-from asyncio import wait
-from datetime import datetime, timedelta
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Text
+import random
+import time
+from asyncio import (
+    AbstractEventLoop,
+    CancelledError,
+    Future,
+    Lock,
+    Queue,
+    Semaphore,
+    ensure_future,
+    gather,
+    get_event_loop,
+    shield,
+    sleep,
+)
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Text,
+    Tuple,
+)
 from urllib.parse import urljoin
 
 import asyncpg
 import httpx
+import orjson
 import sentry_sdk
-from async_lru import alru_cache
 from rasa.cli import utils as cli_utils
 from rasa.core.channels import InputChannel, OutputChannel, UserMessage
 from rasa.core.events import UserUttered
-from sanic import Blueprint, response
+from sanic import Blueprint, Sanic, response
 from sanic.request import Request
 from sanic.response import HTTPResponse
 from sentry_sdk.integrations.logging import LoggingIntegration
 from sentry_sdk.integrations.sanic import SanicIntegration
 
 logger = logging.getLogger(__name__)
-turn_client = httpx.Client()
+# All requests to Turn share this client, so that they reuse keepalive connections.
+# We keep more of those around than the default 10, so that a burst of replies doesn't
+# have to open new connections. Media uploads stream the whole file through, so they
+# get longer than the default 5 second timeouts. HTTP/2 is negotiated over TLS, so
+# concurrent requests can share a connection, falling back to HTTP/1.1
+turn_client = httpx.Client(
+    pool_limits=httpx.PoolLimits(soft_limit=32, hard_limit=100),
+    timeout=httpx.Timeout(30.0, connect_timeout=10.0),
+    http2=True,
+)
 
 SENTRY_DSN = os.environ.get("SENTRY_DSN", None)
 if SENTRY_DSN:
@@ -31,27 +68,218 @@ if SENTRY_DSN:
     )
 
 
-@alru_cache(maxsize=None)
-async def get_media_id(turn_url: Text, turn_token: Text, url: Text, http_retries: int):
-    # TODO: Respect the caching headers from the URL, rather than indefinitely caching
+def json_response(body: Any, status: int = 200) -> HTTPResponse:
+    """
+    Like sanic.response.json, but serialises the body using orjson. Bytes are
+    assumed to already be serialised, and are sent as is
+    """
+    if not isinstance(body, bytes):
+        body = orjson.dumps(body)
+    return response.raw(body, status=status, content_type="application/json")
+
+
+# The webhook only has a few possible responses, so we serialise them up front
+SUCCESS = orjson.dumps({"success": True})
+INVALID_SIGNATURE = orjson.dumps({"success": False, "error": "invalid_signature"})
+INVALID_BODY = orjson.dumps({"success": False, "error": "invalid_body"})
+INVALID_MESSAGE = orjson.dumps({"success": False, "error": "invalid_message"})
+
+
+SIGNATURE_CACHE_SIZE = 4096
+# hashlib releases the GIL while hashing large payloads, so above this size we hash
+# them in a thread, rather than blocking the event loop for longer than the handoff
+SIGNATURE_OFFLOAD_SIZE = 64 * 1024
+signature_cache: "OrderedDict[Tuple[Text, bytes, bytes], bool]" = OrderedDict()
+
+
+@lru_cache(maxsize=16)
+def get_hmac(secret: Text) -> hmac.HMAC:
+    """
+    Returns an HMAC keyed with the secret, that can be copied for each payload, so
+    that we only derive the inner and outer padded key states once per secret
+    """
+    return hmac.new(secret.encode("utf8"), digestmod="sha256")
+
+
+def compute_signature(secret: Text, payload: bytes) -> bytes:
+    mac = get_hmac(secret).copy()
+    mac.update(payload)
+    return mac.digest()
+
+
+# The length of a base64 encoded SHA-256 digest
+SIGNATURE_LENGTH = 44
+
+
+def decode_signature(signature: Text) -> Optional[bytes]:
+    """
+    Decodes a base64 webhook signature, returning None if it can't be a valid signature
+    """
+    # a2b_base64 skips characters that aren't base64, but then a signature of the
+    # right length won't decode to a full digest, so it won't validate
+    if len(signature) != SIGNATURE_LENGTH:
+        return None
+    try:
+        return binascii.a2b_base64(signature)
+    except ValueError:
+        # binascii.Error for bad padding, ValueError for non ASCII characters
+        return None
+
+
+RETRY_BACKOFF_INITIAL = 0.05
+RETRY_BACKOFF_MAX = 1.0
+
+
+def retry_backoff(attempt: int) -> float:
+    """
+    Returns how long to wait after a failed attempt to Turn, counting from 0. Uses
+    exponential backoff with full jitter, so that retries from many messages failing
+    at once are spread out
+    """
+    return random.uniform(
+        0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_INITIAL * 2**attempt)
+    )
+
+
+def should_retry(error: httpx.HTTPError) -> bool:
+    """
+    Whether a failed request might succeed if we try again. Errors without a response,
+    like timeouts, server errors, and rate limiting might, but other client errors
+    will fail the same way every time
+    """
+    if error.response is None:
+        return True
+    return error.response.status_code == 429 or error.response.status_code >= 500
+
+
+MEDIA_CACHE_SIZE = 1024
+# The longest we'll reuse a media ID for, even if the media's caching headers allow more
+MEDIA_CACHE_TTL = 60 * 60
+media_cache: "OrderedDict[Tuple[Text, Text, Text], Tuple[float, Future]]" = (
+    OrderedDict()
+)
+
+
+# Media is streamed through to Turn without being buffered, but we still put a limit on
+# how much of it we'll send, and how many uploads can tie up connections at once
+MEDIA_MAX_SIZE = 16 * 1024 * 1024
+MEDIA_UPLOAD_CONCURRENCY = 8
+_media_upload_semaphore: Optional[Semaphore] = None
+
+
+def get_media_upload_semaphore() -> Semaphore:
+    # Created lazily, so that it belongs to the event loop that the server runs
+    global _media_upload_semaphore
+    if _media_upload_semaphore is None:
+        _media_upload_semaphore = Semaphore(MEDIA_UPLOAD_CONCURRENCY)
+    return _media_upload_semaphore
+
+
+async def limit_size(chunks: AsyncIterator[bytes], url: Text) -> AsyncIterator[bytes]:
+    """
+    Passes through chunks, raising an error once more than MEDIA_MAX_SIZE has been
+    read, for media that doesn't tell us its size upfront
+    """
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > MEDIA_MAX_SIZE:
+            raise ValueError(f"Media at {url} is larger than {MEDIA_MAX_SIZE} bytes")
+        yield chunk
+
+
+def get_max_age(cache_control: Optional[Text]) -> Optional[int]:
+    """
+    Returns how long, in seconds, a Cache-Control header allows a response to be
+    reused for, or None if it doesn't say
+    """
+    max_age = None
+    for directive in (cache_control or "").lower().split(","):
+        directive = directive.strip()
+        if directive in ("no-cache", "no-store"):
+            return 0
+        if directive.startswith("max-age="):
+            try:
+                max_age = max(int(directive.split("=", 1)[1]), 0)
+            except ValueError:
+                pass
+    return max_age
+
+
+async def upload_media(
+    turn_url: Text, turn_token: Text, url: Text, http_retries: int
+) -> Tuple[Text, Optional[int]]:
+    """
+    Uploads the media at url to Turn, returning the Turn media ID, and the max age of
+    the media from its caching headers
+    """
     for i in range(http_retries):
         try:
-            async with turn_client.stream("GET", url) as media_response:
+            async with get_media_upload_semaphore(), turn_client.stream(
+                "GET", url
+            ) as media_response:
                 media_response.raise_for_status()
+                content_length = media_response.headers.get("Content-Length")
+                if content_length and int(content_length) > MEDIA_MAX_SIZE:
+                    # Checked before uploading, so that we don't read any of the body
+                    raise ValueError(
+                        f"Media at {url} is larger than {MEDIA_MAX_SIZE} bytes"
+                    )
                 turn_response = await turn_client.post(
                     urljoin(turn_url, "v1/media"),
                     headers={
                         "Authorization": f"Bearer {turn_token}",
                         "Content-Type": media_response.headers["Content-Type"],
                     },
-                    data=media_response.aiter_bytes(),
+                    data=limit_size(media_response.aiter_bytes(), url),
                 )
                 turn_response.raise_for_status()
-                response_data: Any = turn_response.json()
-                return response_data["media"][0]["id"]
+                media_id = orjson.loads(turn_response.content)["media"][0]["id"]
+                max_age = get_max_age(media_response.headers.get("Cache-Control"))
+                return media_id, max_age
         except httpx.HTTPError as e:
-            if i == http_retries - 1:
+            if i == http_retries - 1 or not should_retry(e):
                 raise e
+            await sleep(retry_backoff(i))
+    raise ValueError("http_retries must be at least 1")
+
+
+async def get_media_id(
+    turn_url: Text, turn_token: Text, url: Text, http_retries: int
+) -> Text:
+    """
+    Returns the Turn media ID for the media at url, only uploading it if we haven't
+    already within the media's max age, and MEDIA_CACHE_TTL. Concurrent calls for the
+    same media share a single upload, and failed uploads aren't cached
+    """
+    key = (turn_url, turn_token, url)
+    cached = media_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        media_cache.move_to_end(key)
+        media_id, _ = await shield(cached[1])
+        return media_id
+
+    upload = ensure_future(upload_media(turn_url, turn_token, url, http_retries))
+    # Until the upload is done, concurrent calls should wait for it
+    media_cache[key] = (math.inf, upload)
+    if len(media_cache) > MEDIA_CACHE_SIZE:
+        media_cache.popitem(last=False)
+
+    def upload_done(upload: Future) -> None:
+        # Done in a callback rather than by this caller, so that the entry is still
+        # updated if this caller is cancelled while the upload carries on
+        if media_cache.get(key, (0, None))[1] is not upload:
+            return
+        if upload.cancelled() or upload.exception() is not None:
+            del media_cache[key]
+            return
+        _, max_age = upload.result()
+        ttl = MEDIA_CACHE_TTL if max_age is None else min(max_age, MEDIA_CACHE_TTL)
+        media_cache[key] = (time.monotonic() + ttl, upload)
+
+    upload.add_done_callback(upload_done)
+    media_id, _ = await shield(upload)
+    return media_id
 
 
 class TurnOutput(OutputChannel):
@@ -76,38 +304,42 @@ class TurnOutput(OutputChannel):
         self.conversation_claim = conversation_claim
         self.http_retries = http_retries
         self.inbound_message_id = inbound_message_id
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.messages_url = urljoin(url, "v1/messages")
         super().__init__()
 
     async def _send_message(
         self, body: Optional[dict], claim: Optional[Text] = "extend", **kwargs
     ) -> None:
-        headers = {"Authorization": f"Bearer {self.token}"}
+        headers = self.headers.copy()
         if self.conversation_claim:
             if claim == "extend":
                 headers["X-Turn-Claim-Extend"] = self.conversation_claim
             elif claim == "release" or claim == "revert":
                 headers["X-Turn-Claim-Release"] = self.conversation_claim
 
-        urlpath = "v1/messages"
+        url = self.messages_url
         if self.conversation_claim and self.inbound_message_id and claim == "revert":
-            urlpath = f"v1/messages/{self.inbound_message_id}/automation"
+            url = urljoin(self.url, f"v1/messages/{self.inbound_message_id}/automation")
             headers["Accept"] = "application/vnd.v1+json"
             body = None
 
+        data = b""
+        if body:
+            data = orjson.dumps(body)
+            headers["Content-Type"] = "application/json"
+        else:
+            headers["Content-Length"] = "0"
+
         for i in range(self.http_retries):
-            if not body:
-                headers["Content-Length"] = "0"
             try:
-                result = await turn_client.post(
-                    urljoin(self.url, urlpath),
-                    headers=headers,
-                    json=body,
-                )
+                result = await turn_client.post(url, headers=headers, data=data)
                 result.raise_for_status()
                 return
             except httpx.HTTPError as e:
-                if i == self.http_retries - 1:
+                if i == self.http_retries - 1 or not should_retry(e):
                     raise e
+                await sleep(retry_backoff(i))
 
     async def send_response(self, recipient_id: Text, message: Dict[Text, Any]) -> None:
         # The Rasa implementation for this sends the text and the media part of the
@@ -166,9 +398,9 @@ class TurnOutput(OutputChannel):
         buttons: List[Dict[Text, Any]],
         **kwargs: Any,
     ) -> None:
-        for idx, button in enumerate(buttons):
-            text += "\n"
-            text += cli_utils.button_to_string(button, idx)
+        text = "\n".join(
+            [text, *(cli_utils.button_to_string(b, i) for i, b in enumerate(buttons))]
+        )
         await self.send_text_message(recipient_id, text, **kwargs)
 
     async def send_custom_json(
@@ -181,6 +413,23 @@ class TurnOutput(OutputChannel):
     # TODO: attachment message type
 
 
+# How far back we look for messages that we've already processed, in seconds
+DEDUPLICATION_WINDOW = 24 * 60 * 60
+# The type name is inlined rather than a parameter, so that postgresql can use the
+# partial index described in the README for any plan
+MESSAGES_PROCESSED_QUERY = f"""
+    SELECT sender_id, data::json ->> 'message_id'
+    FROM events
+    WHERE
+        sender_id = ANY($1::text[]) AND
+        type_name = '{UserUttered.type_name}' AND
+        (sender_id, data::json ->> 'message_id') IN (
+            SELECT * FROM unnest($1::text[], $2::text[])
+        ) AND
+        timestamp > $3
+"""
+
+
 class TurnInput(InputChannel):
     """
     Turn input channel
@@ -201,6 +450,8 @@ class TurnInput(InputChannel):
             credentials["token"],
             credentials.get("postgresql_url"),
             credentials.get("http_retries", 3),
+            credentials.get("message_concurrency", 5),
+            credentials.get("message_queue_size", 0),
         )
 
     def __init__(
@@ -210,82 +461,186 @@ class TurnInput(InputChannel):
         token: Text,
         postgresql_url: Optional[Text],
         http_retries: int,
+        message_concurrency: int = 5,
+        message_queue_size: int = 0,
     ) -> None:
         self.hmac_secret = hmac_secret
         self.url = url
         self.token = token
         self.postgresql_url = postgresql_url
-        self._postgresql_pool = None
+        self._postgresql_pool: Optional[asyncpg.pool.Pool] = None
+        self._postgresql_pool_lock: Optional[Lock] = None
         self.http_retries = http_retries
+        # These can come from YAML as strings, and bad values would otherwise only
+        # show up as every webhook failing or hanging
+        self.message_concurrency = int(message_concurrency)
+        if self.message_concurrency < 1:
+            raise ValueError("message_concurrency must be at least 1")
+        self.message_queue_size = int(message_queue_size)
+        if self.message_queue_size < 0:
+            raise ValueError("message_queue_size can't be negative")
+        self._message_queue: Optional[Queue] = None
+        self._message_queue_closing = False
+        self._message_queue_puts: Set[Future] = set()
+        # Messages that are queued or being handled aren't in the tracker store yet,
+        # so we deduplicate against these as well
+        self._queued_messages: Set[Tuple[Text, Text]] = set()
+        self._message_workers: List[Future] = []
+        self._message_handlers: Dict[Text, Callable[[dict], UserMessage]] = {}
 
     async def get_postgresql_pool(self) -> Optional[asyncpg.pool.Pool]:
         if self._postgresql_pool is None and self.postgresql_url is not None:
-            self._postgresql_pool = await asyncpg.create_pool(self.postgresql_url)
+            # The lock is created here rather than in __init__, so that it belongs to
+            # the server's event loop. It stops concurrent messages each creating a pool
+            if self._postgresql_pool_lock is None:
+                self._postgresql_pool_lock = Lock()
+            async with self._postgresql_pool_lock:
+                if self._postgresql_pool is None:
+                    self._postgresql_pool = await asyncpg.create_pool(
+                        self.postgresql_url
+                    )
         return self._postgresql_pool
 
+    async def start_message_workers(
+        self, on_new_message: Callable[[UserMessage], Awaitable[Any]]
+    ) -> None:
+        """
+        If message_queue_size is set, starts message_concurrency workers to handle the
+        messages that the webhook queues
+        """
+        if not self.message_queue_size or self._message_queue is not None:
+            return
+        # Created here rather than in __init__, so that it belongs to the server's loop
+        queue: Queue = Queue(maxsize=self.message_queue_size)
+
+        async def worker() -> None:
+            while True:
+                user_message = await queue.get()
+                try:
+                    await on_new_message(user_message)
+                except CancelledError:
+                    # On Python 3.7, this is an Exception, and it should stop the worker
+                    raise
+                except Exception:
+                    logger.exception("Error handling message")
+                finally:
+                    self._queued_messages.discard(
+                        (user_message.sender_id, user_message.message_id)
+                    )
+                    queue.task_done()
+
+        self._message_queue = queue
+        self._message_workers = [
+            ensure_future(worker()) for _ in range(self.message_concurrency)
+        ]
+
+    async def stop_message_workers(self) -> None:
+        """
+        Waits for the queued messages to be handled, and then stops the workers
+        """
+        queue = self._message_queue
+        if queue is None:
+            return
+        # Webhooks stop queueing messages, and handle the rest of their batch
+        # themselves. One that's already waiting for space still queues that message,
+        # so we wait for those puts before waiting for the queue to be handled
+        self._message_queue_closing = True
+        await gather(*self._message_queue_puts, return_exceptions=True)
+        await queue.join()
+        for task in self._message_workers:
+            task.cancel()
+        await gather(*self._message_workers, return_exceptions=True)
+        self._message_workers = []
+        self._message_queue = None
+        self._message_queue_closing = False
+
     async def message_processed(
         self, sender_id: Optional[Text], message_id: Optional[Text]
     ) -> bool:
         """
         Have we processed a message with this ID before
         """
-        if not sender_id or not message_id:
-            return False
+        processed = await self.messages_processed([(sender_id, message_id)])
+        return (sender_id, message_id) in processed
+
+    async def messages_processed(
+        self, messages: List[Tuple[Optional[Text], Optional[Text]]]
+    ) -> Set[Tuple[Text, Text]]:
+        """
+        Which of these (sender ID, message ID) pairs have we processed before. Checks
+        them all in a single query, so that a batch only needs one round trip
+        """
+        messages = [(s, m) for s, m in messages if s and m]
+        if not messages:
+            return set()
 
         pool = await self.get_postgresql_pool()
         if pool is None:
             # If we don't have a postgresql config, don't deduplicate
-            return False
+            return set()
+        sender_ids, message_ids = zip(*messages)
         async with pool.acquire() as connection:
-            async with connection.transaction():
-                result = await connection.fetchval(
-                    """
-                    SELECT 1
-                    FROM events
-                    WHERE
-                        sender_id = $1 AND
-                        type_name = $2 AND
-                        data::json ->> 'message_id' = $3 AND
-                        timestamp > $4
-                    LIMIT 1
-                    """,
-                    sender_id,
-                    UserUttered.type_name,
-                    message_id,
-                    (datetime.utcnow() - timedelta(days=1)).timestamp(),
-                )
-                return result == 1
+            rows = await connection.fetch(
+                MESSAGES_PROCESSED_QUERY,
+                list(sender_ids),
+                list(message_ids),
+                time.time() - DEDUPLICATION_WINDOW,
+            )
+        return {(row[0], row[1]) for row in rows}
 
     def blueprint(
         self, on_new_message: Callable[[UserMessage], Awaitable[Any]]
     ) -> Blueprint:
         turn_webhook = Blueprint("turn_webhook", __name__)
+        if not self.hmac_secret:
+            # Warned about once here, rather than on every webhook
+            logger.warning("hmac_secret config not set, not validating signatures")
+
+        @turn_webhook.listener("before_server_start")
+        async def start_message_workers(app: Sanic, loop: AbstractEventLoop) -> None:
+            await self.start_message_workers(on_new_message)
+
+        @turn_webhook.listener("before_server_stop")
+        async def stop_message_workers(app: Sanic, loop: AbstractEventLoop) -> None:
+            await self.stop_message_workers()
+
+        @turn_webhook.listener("after_server_stop")
+        async def close_turn_client(app: Sanic, loop: AbstractEventLoop) -> None:
+            # Close the keepalive connections that we've been reusing to talk to Turn
+            await turn_client.close()
+
+        @turn_webhook.listener("after_server_stop")
+        async def close_postgresql_pool(app: Sanic, loop: AbstractEventLoop) -> None:
+            if self._postgresql_pool is not None:
+                await self._postgresql_pool.close()
+                self._postgresql_pool = None
 
         @turn_webhook.route("/", methods=["GET"])
         async def health(request: Request) -> HTTPResponse:
-            return response.json({"status": "ok"})
+            return json_response({"status": "ok"})
 
         @turn_webhook.route("/webhook", methods=["POST"])
         async def webhook(request: Request) -> HTTPResponse:
+            body = request.body
             if self.hmac_secret:
-                signature = request.headers.get("X-Turn-Hook-Signature") or ""
-                valid_signature = self.validate_signature(
-                    self.hmac_secret, request.body, signature
+                signature = decode_signature(
+                    request.headers.get("X-Turn-Hook-Signature") or ""
                 )
-                if not valid_signature:
-                    return response.json(
-                        {"success": False, "error": "invalid_signature"}, status=401
-                    )
-            else:
-                logging.warning("hmac_secret config not set, not validating signature")
-
+                if signature is None or not await self.validate_signature_async(
+                    self.hmac_secret, body, signature
+                ):
+                    return json_response(INVALID_SIGNATURE, status=401)
+
+            # Reject anything that can't be a JSON object before we try to parse it
+            if body.lstrip(b" \t\r\n")[:1] != b"{":
+                return json_response(INVALID_BODY, status=400)
             try:
-                messages = request.json.get("messages", [])
-                assert isinstance(messages, list)
-            except (TypeError, AttributeError, AssertionError):
-                return response.json(
-                    {"success": False, "error": "invalid_body"}, status=400
-                )
+                data = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                return json_response(INVALID_BODY, status=400)
+            messages = data.get("messages", []) if isinstance(data, dict) else None
+            if not isinstance(messages, list):
+                return json_response(INVALID_BODY, status=400)
 
             conversation_claim = request.headers.get("X-Turn-Claim", None)
 
@@ -293,34 +648,128 @@ class TurnInput(InputChannel):
             for message in messages:
                 try:
                     message["conversation_claim"] = conversation_claim
-                    processed = await self.message_processed(
-                        message.get("from"), message.get("id")
-                    )
-                    if not processed:
-                        user_messages.append(self.extract_message(message))
+                    user_messages.append(self.extract_message(message))
                 except (TypeError, KeyError, AttributeError):
-                    logger.warning(f"Invalid message: {json.dumps(message)}")
-                    return response.json(
-                        {"success": False, "error": "invalid_message"}, status=400
+                    logger.warning(f"Invalid message: {orjson.dumps(message).decode()}")
+                    return json_response(INVALID_MESSAGE, status=400)
+
+            processed = await self.messages_processed(
+                [(m.sender_id, m.message_id) for m in user_messages]
+            )
+
+            new_messages = [
+                m
+                for m in user_messages
+                if (m.sender_id, m.message_id) not in processed
+                and (m.sender_id, m.message_id) not in self._queued_messages
+            ]
+
+            queue = self._message_queue
+            if queue is not None and not self._message_queue_closing:
+                # Turn gets its response as soon as the messages are queued, rather
+                # than waiting for Rasa. If the queue is full, we wait for space. If
+                # the workers start stopping, we handle what's left like below
+                self._queued_messages.update(
+                    (m.sender_id, m.message_id) for m in new_messages
+                )
+                queued = 0
+                try:
+                    while queued < len(new_messages):
+                        if self._message_queue_closing:
+                            break
+                        # Shielded and tracked until it's done, even if this request
+                        # is cancelled, so that stopping waits for it to be queued
+                        put = ensure_future(queue.put(new_messages[queued]))
+                        self._message_queue_puts.add(put)
+                        put.add_done_callback(self._message_queue_puts.discard)
+                        await shield(put)
+                        queued += 1
+                except CancelledError:
+                    # The rest of the batch won't be queued, so redeliveries of it
+                    # shouldn't be skipped. The put we were waiting on still happens
+                    self._queued_messages.difference_update(
+                        (m.sender_id, m.message_id)
+                        for m in islice(new_messages, queued + 1, None)
+                    )
+                    raise
+                if queued == len(new_messages):
+                    return json_response(SUCCESS)
+                new_messages = new_messages[queued:]
+
+            # Limit how many messages from the batch Rasa is handling at once, so
+            # that a large batch doesn't take all the tracker store's connections
+            semaphore = Semaphore(self.message_concurrency)
+
+            async def handle_message(user_message: UserMessage) -> None:
+                try:
+                    async with semaphore:
+                        await on_new_message(user_message)
+                finally:
+                    # Left over from the queue, if the workers stopped
+                    self._queued_messages.discard(
+                        (user_message.sender_id, user_message.message_id)
                     )
 
-            if user_messages:
-                # wait doesn't like empty lists
-                await wait(list(map(on_new_message, user_messages)))
-            return response.json({"success": True})
+            # A failure handling one message shouldn't stop the others from being
+            # handled, so we log them instead of raising
+            results = await gather(
+                *(handle_message(m) for m in new_messages), return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Error handling message", exc_info=result)
+            return json_response(SUCCESS)
 
         return turn_webhook
 
     @staticmethod
     def validate_signature(secret: Text, payload: bytes, signature: Text) -> bool:
-        decoded_secret = secret.encode("utf8")
-        decoded_signature = base64.b64decode(signature)
-        digest = hmac.new(decoded_secret, payload, "sha256").digest()
-        return hmac.compare_digest(digest, decoded_signature)
+        decoded_signature = decode_signature(signature)
+        if decoded_signature is None:
+            return False
+        return TurnInput.validate_signature_bytes(secret, payload, decoded_signature)
+
+    @staticmethod
+    def validate_signature_bytes(
+        secret: Text, payload: bytes, signature: bytes
+    ) -> bool:
+        # Turn retries webhooks with the same payload and signature, so we cache the
+        # result of both valid and invalid signatures, keyed on a digest of the payload
+        key = (secret, hashlib.blake2b(payload, digest_size=16).digest(), signature)
+        try:
+            valid = signature_cache[key]
+        except KeyError:
+            digest = compute_signature(secret, payload)
+            valid = signature_cache[key] = hmac.compare_digest(digest, signature)
+            if len(signature_cache) > SIGNATURE_CACHE_SIZE:
+                signature_cache.popitem(last=False)
+        else:
+            signature_cache.move_to_end(key)
+        return valid
+
+    @staticmethod
+    async def validate_signature_async(
+        secret: Text, payload: bytes, signature: bytes
+    ) -> bool:
+        if len(payload) < SIGNATURE_OFFLOAD_SIZE:
+            return TurnInput.validate_signature_bytes(secret, payload, signature)
+        # Payloads this big would need hashing for the cache key anyway, so we skip
+        # the cache, and only compute the HMAC
+        digest = await get_event_loop().run_in_executor(
+            None, compute_signature, secret, payload
+        )
+        return hmac.compare_digest(digest, signature)
 
     def extract_message(self, message: dict) -> UserMessage:
+        # The bound handle_ methods are looked up once per type, and then kept, so
+        # that subclasses can override or add handlers. Raises an AttributeError for
+        # message types that we don't have a handler for
         message_type = message["type"]
-        handler = getattr(self, f"handle_{message_type}")
+        try:
+            handler = self._message_handlers[message_type]
+        except KeyError:
+            handler = getattr(self, f"handle_{message_type}")
+            self._message_handlers[message_type] = handler
         return handler(message)
 
     def handle_common(self, text: Text, message: dict) -> UserMessage: